@@ -2,15 +2,17 @@
 # Christoph Weniger <c.weniger@uva.nl>, June, July 2023
 # Noemi Anau Montel <n.anaumontel@uva.nl>, June, July, August 2023
 
+import heapq
+
 import torch
 import numpy as np
 from tqdm.auto import tqdm
 
 
 class NestedSampler:
-    def __init__(self, X_init, L_init=None, bound="unitcube"):
+    def __init__(self, X_init, L_init=None, bound="unitcube", compile_step=False):
         self.X_init = X_init
-        self.X_live = X_init * 1.0
+        self.X_live = X_init.clone()
         self.L_live = L_init if L_init is not None else None
         self.device = X_init.device
 
@@ -22,33 +24,32 @@ class NestedSampler:
             raise KeyError("Bound unknown")
         assert all(self._inbound(X_init)), "X_init not within specified bounds"
 
+        if compile_step:  # Compile the slice sampling step with torch.compile
+            if not hasattr(torch, "compile"):
+                raise RuntimeError("compile_step=True requires torch>=2.0")
+            self._slice_step = torch.compile(self._slice_step)
+
     def _inbound_unitcube(self, X):
         """This function checks if samples are inside boundaries."""
-        return (X <= 1).prod(-1) * (X >= 0).prod(-1)
+        return ((X >= 0) & (X <= 1)).all(dim=-1)
 
     def _get_directions(self, B, D):
         """This function generates a minibatch of D-dimensional random directions."""
         t = torch.randn(B, D, device=self.device)
-        l = (t**2).sum(axis=-1) ** 0.5
-        n = t / l.unsqueeze(-1)
-        return n
+        return torch.nn.functional.normalize(t, dim=-1, eps=1e-30)
 
     def _get_slice_sample_points(self, B, S):
         """This function generates a minibatch of S slice sample positions."""
-        hard_bounds = (
-            torch.tensor([-1.0, 1.0], device=self.device).unsqueeze(0).repeat((B, 1))
-        )
-        current_bounds = hard_bounds.clone()
+        lo = torch.full((B,), -1.0, device=self.device)  # current lower slice bounds
+        hi = torch.full((B,), 1.0, device=self.device)  # current upper slice bounds
+        U = torch.rand((B, S), device=self.device)
         L = torch.empty((B, S), device=self.device)
         for i in range(S):
-            x = (
-                torch.rand(B, device=self.device)
-                * (current_bounds[:, 1] - current_bounds[:, 0])
-                + current_bounds[:, 0]
-            )
+            x = U[:, i] * (hi - lo) + lo
             L[:, i] = x
-            current_bounds[x < 0, 0] = x[x < 0]
-            current_bounds[x > 0, 1] = x[x > 0]
+            neg = x < 0
+            lo = torch.where(neg, x, lo)
+            hi = torch.where(neg, hi, x)
         return L
 
     def _gen_new_samples(
@@ -60,33 +61,51 @@ class NestedSampler:
         max_step_size=1.0,
         samples_per_slice=5,
         Lchol=None,
+        logl_seeds=None,
     ):
         """This function generates new samples within the likelihood constraint logl_fn > log_th."""
         if Lchol is None:
             Lchol = self._calc_Lchol(X_seeds)
+        Lchol_T = Lchol.T.to(self.device).contiguous()
         B, D = X_seeds.shape
-        C = torch.zeros(B, device=self.device)  # counter for accepted points
-        X = X_seeds.clone()
-        logl = torch.ones(B, device=self.device) * (-np.inf)
+        X = X_seeds  # _slice_step works on copies, so the seeds are not modified
+        if logl_seeds is None:
+            logl = torch.full((B,), -np.inf, device=self.device)
+        else:  # Known seed likelihoods are only returned as-is when num_steps=0
+            logl = logl_seeds
         for i in range(num_steps):
-            N = self._get_directions(B, D)
-            L = self._get_slice_sample_points(B, S=samples_per_slice) * max_step_size
-            dX_uniform = N.unsqueeze(-2) * L.unsqueeze(-1)
-            dX = torch.matmul(dX_uniform, Lchol.T.to(self.device))
-            pX = X.unsqueeze(-2) + dX  # proposals
-            pX_shape = pX.shape
-            pX2 = pX.flatten(0, -2)
-            logl_prop = logl_fn(pX2).view(*pX_shape[:-2], -1)
-            inbound = self._inbound(pX2).view(*pX_shape[:-2], -1)
-            accept_matrix = ((logl_prop > logl_th) * inbound).bool()
-            idx = torch.argmax(accept_matrix.int(), dim=1)
-            nX = torch.stack([pX[i][idx[i]] for i in range(B)], dim=0)
-            logl_selected = torch.stack([logl_prop[i][idx[i]] for i in range(B)], dim=0)
-            accept_any = accept_matrix.sum(dim=-1) > 0
-            X[accept_any] = nX[accept_any]
-            logl[accept_any] = logl_selected[accept_any]
-            C[accept_any] += 1
-        return X[C == num_steps], logl[C == num_steps]
+            X, logl, accept_any = self._slice_step(
+                X, logl, logl_fn, logl_th, Lchol_T, max_step_size, samples_per_slice
+            )
+            # Chains that fail to move in any step are discarded, so drop them now
+            X, logl = X[accept_any], logl[accept_any]
+            if len(X) == 0:
+                break
+        return X, logl
+
+    def _slice_step(
+        self, X, logl, logl_fn, logl_th, Lchol_T, max_step_size, samples_per_slice
+    ):
+        """This function performs one slice sampling step for a minibatch of chains."""
+        B, D = X.shape
+        N = self._get_directions(B, D)
+        L = self._get_slice_sample_points(B, S=samples_per_slice) * max_step_size
+        dX_uniform = N.unsqueeze(-2) * L.unsqueeze(-1)
+        dX = torch.matmul(dX_uniform, Lchol_T)
+        X, logl = X.clone(), logl.clone()
+        accept_any = torch.zeros(B, dtype=torch.bool, device=self.device)
+        rows = torch.arange(B, device=self.device)  # chains without accepted point
+        for s in range(samples_per_slice):  # Stop at the first accepted proposal
+            pX = X[rows] + dX[rows, s]  # proposals
+            logl_prop = logl_fn(pX)
+            accept = (logl_prop > logl_th) & self._inbound(pX).bool()
+            X[rows[accept]] = pX[accept]
+            logl[rows[accept]] = logl_prop[accept]
+            accept_any[rows[accept]] = True
+            rows = rows[~accept]
+            if len(rows) == 0:
+                break
+        return X, logl, accept_any
 
     def nested_sampling(
         self,
@@ -108,30 +127,39 @@ class NestedSampler:
         else:
             L_live = self.L_live
         B = min(num_batch_samples, NLP)  # Number of samples generated simultanously
-        V = 1.0  # initial volume is set to 1.
-        samples_X = []
-        samples_logl = []  # logl values
-        samples_logv = []  # estimate of constrained volume
-        samples_Z = []
-        samples_logwt = []
+        logV = torch.zeros((), device=self.device)  # initial volume is set to 1.
+        logq = np.log1p(-1 / NLP)  # log volume shrinkage per replaced point
+        cap = 16384  # initial capacity of the sample buffers, doubled when full
+        samples_X = torch.empty((cap, D), dtype=X_live.dtype, device=self.device)
+        samples_logl = torch.empty(cap, dtype=L_live.dtype, device=self.device)
+        samples_logv = torch.empty(cap, device=self.device)  # constrained volume
+        samples_logwt = torch.empty(cap, dtype=L_live.dtype, device=self.device)
+        n_stored = 0
         logl_th = torch.tensor(-np.inf)
-        Z = 0
-        Z_rest = torch.tensor(np.inf)
+        logZ = torch.full((), -np.inf, device=self.device)
+        logZ_rest = torch.full((), np.inf, device=self.device)
+        X_ref, S1, S2 = self._calc_moments(X_live)  # running live-point moments
+        n_updated = 0  # live points replaced since the moments were last refreshed
 
         pbar = tqdm(range(max_steps))
         for i in pbar:
-            pbar.set_description(
-                "Z_sum=%.2e, Z_rest=%.2e, logl_min=%.2f"
-                % (Z, Z_rest.item(), logl_th.item())
-            )
-            idx_batch = np.random.choice(range(NLP), B, replace=True)
+            if i % 50 == 0:  # Throttle updates, each one synchronises with the device
+                pbar.set_description(
+                    "logZ_sum=%.2f, logZ_rest=%.2f, logl_min=%.2f"
+                    % (logZ.item(), logZ_rest.item(), logl_th.item())
+                )
+            idx_batch = torch.randint(0, NLP, (B,), device=self.device)
             X_batch = X_live[idx_batch]
             logl_th = L_live.min()
             if (
                 logl_th > logl_th_max
             ):  # Stop sampling once maxmimum threshold is reached
                 break
-            Lchol = self._calc_Lchol(X_live)
+            if n_updated >= NLP:  # Refresh to avoid accumulating round-off errors
+                X_ref, S1, S2 = self._calc_moments(X_live)
+                n_updated = 0
+            cov = (S2 - torch.outer(S1, S1) / NLP) / (NLP - 1)
+            Lchol = self._cov_cholesky(cov)
             X_new, L_new = self._gen_new_samples(
                 X_batch,
                 logl_fn,
@@ -142,29 +170,52 @@ class NestedSampler:
                 samples_per_slice=samples_per_slice,
             )
 
-            for i in range(len(X_new)):
-                if L_new[i] > L_live.min():
-                    idx_min = np.argmin(L_live.cpu().numpy())
-                    Lmin = L_live[idx_min].item() * 1.0
-                    samples_X.append(1.0 * X_live[idx_min].cpu().numpy())
-                    samples_logl.append(Lmin)
-                    samples_logv.append(np.log(V))
-                    L_live[idx_min] = L_new[i] * 1.0
-                    X_live[idx_min] = X_new[i] * 1.0
-                    V *= 1 - 1 / NLP  # Volume estimate per sample
-                    dZ = V / NLP * np.exp(Lmin)
-                    samples_Z.append(dZ)
-                    samples_logwt.append(Lmin + np.log(V / NLP))
-                    Z = Z + dZ
-                    Z_rest = V * torch.exp(L_live.max() * 1.0)
-                else:
-                    break
-            if Z_rest < Z * epsilon:
+            # Replay one-by-one replacement of the live minimum on the host, then
+            # apply the resulting dead points and replacements in one go.
+            Lmin, idx_min = torch.topk(L_live, len(L_new), largest=False)
+            dead, k_old, alive = self._replay_replacements(Lmin, L_new)
+            k = len(dead)
+            if k > 0:
+                dead = torch.tensor(dead, device=self.device)
+                X_dead = torch.cat([X_live[idx_min], X_new])[dead]
+                L_dead = torch.cat([Lmin, L_new])[dead]
+                logv = logV + logq * torch.arange(
+                    k + 1, device=self.device
+                )  # Volume estimates before and after each replacement
+                logwt = L_dead + logv[1:] - np.log(NLP)
+                while n_stored + k > len(samples_logl):
+                    samples_X, samples_logl, samples_logv, samples_logwt = (
+                        torch.cat([buf, torch.empty_like(buf)])
+                        for buf in (
+                            samples_X,
+                            samples_logl,
+                            samples_logv,
+                            samples_logwt,
+                        )
+                    )
+                samples_X[n_stored : n_stored + k] = X_dead
+                samples_logl[n_stored : n_stored + k] = L_dead
+                samples_logv[n_stored : n_stored + k] = logv[:-1]
+                samples_logwt[n_stored : n_stored + k] = logwt
+                n_stored += k
+                idx_min = idx_min[:k_old]
+                alive = torch.tensor(alive, dtype=torch.long, device=self.device)
+                X_old, X_new = X_live[idx_min], X_new[alive]
+                L_live[idx_min] = L_new[alive]
+                X_live[idx_min] = X_new
+                Xc_old, Xc_new = X_old - X_ref, X_new - X_ref
+                S1 += Xc_new.sum(0) - Xc_old.sum(0)
+                S2 += Xc_new.T.matmul(Xc_new) - Xc_old.T.matmul(Xc_old)
+                n_updated += k_old
+                logV = logv[-1]
+                logZ = torch.logaddexp(logZ, torch.logsumexp(logwt, dim=0))
+                logZ_rest = logV + L_live.max()
+            if logZ_rest < logZ + np.log(epsilon):
                 break
-        samples_logv = torch.tensor(np.array(samples_logv)).float()
-        samples_logl = torch.tensor(np.array(samples_logl)).float()
-        samples_X = torch.tensor(np.array(samples_X)).float()
-        samples_logwt = torch.tensor(np.array(samples_logwt)).float()
+        samples_logv = samples_logv[:n_stored].cpu().float()
+        samples_logl = samples_logl[:n_stored].cpu().float()
+        samples_X = samples_X[:n_stored].cpu().float()
+        samples_logwt = samples_logwt[:n_stored].cpu().float()
         self.X_live = X_live
         self.L_live = L_live
         self.samples_X = samples_X
@@ -172,19 +223,46 @@ class NestedSampler:
         self.samples_logl = samples_logl
         self.samples_logwt = samples_logwt
 
+    def _replay_replacements(self, Lmin, L_new):
+        """This function replays one-by-one replacement of the live minimum by new samples."""
+        Lmin, L_new = Lmin.tolist(), L_new.tolist()  # Lmin sorted ascending
+        K = len(Lmin)
+        dead = []  # dead points, indexing the concatenation of Lmin and L_new
+        alive = []  # heap of (logl, index) of inserted new samples still alive
+        j = 0  # number of killed old live points, always the first ones in Lmin
+        for i, logl in enumerate(L_new):
+            if alive and alive[0][0] < Lmin[j]:  # New samples can die in the batch
+                if not logl > alive[0][0]:
+                    break
+                dead.append(K + heapq.heappushpop(alive, (logl, i))[1])
+            else:
+                if not logl > Lmin[j]:
+                    break
+                dead.append(j)
+                j += 1
+                heapq.heappush(alive, (logl, i))
+        # Surviving new samples take the places of the killed old live points
+        return dead, j, sorted(i for _, i in alive)
+
     def generate_constrained_prior_samples(
         self, logl_fn, N, min_logl=-np.inf, batch_size=100, num_steps=10
     ):
         """This function generates new constrained prior samples inside the iso-contour defined by min_logl."""
-        X_seeds, _ = self.get_constrained_prior_samples(N, min_logl=min_logl)
-        X_seeds = X_seeds.to(self.device)
+        X_seeds, L_seeds = self.get_constrained_prior_samples(N, min_logl=min_logl)
+        X_seeds, L_seeds = X_seeds.to(self.device), L_seeds.to(self.device)
         X_samples = []
         L_samples = []
         Lchol = self._calc_Lchol(X_seeds)
         for i in tqdm(range(N // batch_size)):
             X_batch = X_seeds[i * batch_size : (i + 1) * batch_size]
+            L_batch = L_seeds[i * batch_size : (i + 1) * batch_size]
             X_new, L_new = self._gen_new_samples(
-                X_batch, logl_fn, min_logl, num_steps=num_steps
+                X_batch,
+                logl_fn,
+                min_logl,
+                num_steps=num_steps,
+                Lchol=Lchol,
+                logl_seeds=L_batch,
             )
             X_samples.append(X_new)
             L_samples.append(L_new)
@@ -192,28 +270,23 @@ class NestedSampler:
 
     def get_threshold(self, p):
         """This function defines defines the convergence criterion related to posterior mass."""
-        wt = np.exp(self.samples_logwt)
-        wt /= wt.sum()
-        cwt = np.cumsum(wt)
-        return np.interp(p, cwt, self.samples_logl)
+        wt = torch.softmax(self.samples_logwt, dim=0)
+        cwt = torch.cumsum(wt, dim=0)
+        return np.interp(p, cwt.cpu().numpy(), self.samples_logl.cpu().numpy())
 
     def get_posterior_samples(self, N=None):
         """This function generates posterior samples."""
         if N is None:
             N = int(self.get_posterior_neff())
-        logwt = self.samples_logwt
-        wt = torch.exp(logwt - logwt.max())
-        wt /= wt.sum()
+        wt = torch.softmax(self.samples_logwt, dim=0)
         idx = torch.multinomial(wt, N, replacement=True)
         return self.samples_X[idx], self.samples_logl[idx]
 
     def get_posterior_neff(self):
         """This function returns the number of effective posterior samples."""
         logwt = self.samples_logwt
-        wt = torch.exp(logwt - logwt.max())
-        wt /= wt.sum()
-        n_eff = sum(wt) ** 2 / sum(wt**2)
-        return n_eff.item()
+        log_neff = 2 * torch.logsumexp(logwt, dim=0) - torch.logsumexp(2 * logwt, dim=0)
+        return log_neff.exp().item()
 
     def get_constrained_prior_samples(self, N=None, min_logl=-np.inf):
         """This function generates constrained prior samples."""
@@ -222,7 +295,7 @@ class NestedSampler:
         logv = self.samples_logv
         logl = self.samples_logl
         mask = logl >= min_logl
-        wt = torch.exp(logv[mask] - logv[mask].max())
+        wt = torch.softmax(logv[mask], dim=0)
         idx = torch.multinomial(wt, N, replacement=True)
         return self.samples_X[mask][idx], self.samples_logl[mask][idx]
 
@@ -231,18 +304,28 @@ class NestedSampler:
         logv = self.samples_logv
         logl = self.samples_logl
         mask = logl >= min_logl
-        wt = torch.exp(logv[mask] - logv[mask].max())
-        n_eff = sum(wt) ** 2 / sum(wt**2)
-        return n_eff.item()
+        logv = logv[mask]
+        log_neff = 2 * torch.logsumexp(logv, dim=0) - torch.logsumexp(2 * logv, dim=0)
+        return log_neff.exp().item()
+
+    def _calc_moments(self, X):
+        """Return the mean of X and the first and second moment sums of X about it"""
+        X_ref = X.mean(0)
+        Xc = X - X_ref
+        return X_ref, Xc.sum(0), Xc.T.matmul(Xc)
 
     def _calc_Lchol(self, X):
         """Estimate Cholesky decomposition of X covariance"""
-        cov = torch.cov(X.T)
-        try:  # Deal with negative covariance matrices
-            L = torch.linalg.cholesky(cov)
-        except torch.linalg.LinAlgError:
+        Xc = X - X.mean(0, keepdim=True)
+        cov = Xc.T.matmul(Xc) / (X.shape[0] - 1)
+        return self._cov_cholesky(cov)
+
+    def _cov_cholesky(self, cov):
+        """Cholesky decomposition of a covariance matrix"""
+        L, info = torch.linalg.cholesky_ex(cov)
+        if info.item() != 0:  # Deal with negative covariance matrices
             eigvals = torch.linalg.eigvalsh(cov)
             mineig = eigvals.min()
             cov = cov - 2 * mineig * torch.eye(len(cov), device=mineig.device)
             L = torch.linalg.cholesky(cov)
-        return L
+        return L.to(self.device)